@@ -1,186 +1,504 @@
-from collections import deque
-import json
+import asyncio
 import os
+import sqlite3
 import time
-from typing import Dict, Optional
+from typing import Dict, List, Optional, Tuple
 
+import orjson
 import requests
+from requests.adapters import HTTPAdapter
 import logging
 
 
 class APIRequestManager:
     """
-    A class representing a request queue. The queue is implemented to conform
-    to the INSPIRE API rate limiter.
+    A class representing a rate-limited API client. The rate limiter is a token
+    bucket, implemented to conform to the INSPIRE API rate limiter.
 
     Attributes:
-        queue (deque): A deque object to store the requests.
-        max_requests (int): The maximum number of requests allowed in the queue.
+        max_requests (int): The maximum number of requests allowed in the time window.
         time_window (int): The time window (in seconds) within which requests are considered valid.
+        capacity (float): The maximum number of tokens in the bucket.
+        tokens (float): The number of requests that can currently be made.
+        rate (float): The rate (in tokens per second) at which the bucket refills.
+        max_retries (int): The number of times a rate-limited request is retried.
+        session (requests.Session): A session that keeps the connection to INSPIRE alive.
+        refresh_cache (bool): If True, ignore cached responses and titles and fetch them
+            again, overwriting the cache.
+        cache_expiry (int): The age (in seconds) after which a cached response is refetched.
+        title_batch_size (int): The maximum number of records per batched title search.
+        max_title_query_length (int): The maximum length of the query of a batched
+            title search.
+        max_in_flight (int): The maximum number of concurrent requests, and the size of
+            the connection pool.
 
     Methods:
-        enqueue(request_time): Adds a request to the queue.
-        dequeue(): Removes and returns the oldest request from the queue.
         can_make_request(): Checks if a request can be made based on the current state
-            of the request queue.
-        wait_until_request_possible(): Waits until a request can be made based on the
-            current state of the request queue.
-        make_api_request(url): Makes an API request, given a URL, taking the timing into account.
-            If we cannot make a request, then wait until we can.
+            of the token bucket.
+        wait_until_request_possible_async(): Waits until a request can be made based on
+            the current state of the token bucket, and takes a token.
+        make_api_request_async(url): Makes an API request, given a URL, taking the timing
+            into account. Several requests can be in flight at once.
+        find_titles_from_inspire_records_async(record_nums): Looks up the titles of several
+            INSPIRE records, batching uncached records into search queries sent concurrently.
     """
 
-    def __init__(self):
-        self.queue = deque()
+    def __init__(self, refresh_cache: bool = False):
+        self.refresh_cache = refresh_cache
+        self.cache_expiry = 7 * 24 * 60 * 60
         self.max_requests = 15
         self.time_window = 5
+        self.title_batch_size = 100
+        self.max_title_query_length = 2000
+        self.max_in_flight = 16
+        self.max_retries = 3
         self.logger = logging.getLogger(__name__)
+        self._title_cache: Optional[Dict[str, str]] = None
+        self._mem_cache: Dict[str, Dict] = {}
+        self._cache_db: Optional[sqlite3.Connection] = None
+        self._async_lock: Optional[asyncio.Lock] = None
+        self._in_flight_slots: Optional[asyncio.Semaphore] = None
+        self._in_flight: Dict[str, asyncio.Future] = {}
+
+        # Any time_window can see a full bucket plus everything refilled during
+        # it, so the bucket holds a single token and refills the rest of
+        # max_requests per time_window; no time_window then sees more than
+        # max_requests, while the sustained rate stays close to the limit
+        self.capacity = 1.0
+        self.tokens = self.capacity
+        self.rate = (self.max_requests - self.capacity) / self.time_window
+        self._last_refill = time.monotonic()
+
+        # All requests go to the same host, so reuse one pooled connection
+        # rather than opening a new TCP/TLS connection per request
+        self.session = requests.Session()
+        self.session.mount("https://", HTTPAdapter(pool_connections=1,
+                                                   pool_maxsize=self.max_in_flight))
+
+    def _refill(self):
+        """
+        Adds the tokens accumulated since the last refill to the bucket.
+        """
+        now = time.monotonic()
+        self.tokens = min(self.capacity,
+                          self.tokens + (now - self._last_refill) * self.rate)
+        self._last_refill = now
 
-    def enqueue(self, request_time):
+    def can_make_request(self):
         """
-        Adds a request to the queue.
+        Checks if a request can be made based on the current state of the token bucket.
 
-        Args:
-            request_time (float): The time at which the request was made.
+        Returns:
+            bool: True if a request can be made, False otherwise.
+        """
+        self._refill()
+        return self.tokens >= 1
+
+    async def wait_until_request_possible_async(self):
         """
-        self.queue.append(request_time)
-        self._remove_expired_requests()
+        Waits, without blocking the event loop, until a request can be made, and then
+        takes a token from the bucket.
 
-    def dequeue(self):
+        Concurrent callers are admitted one at a time, so that the rate limit holds
+        across every in-flight request.
         """
-        Removes and returns the oldest request from the queue.
+        if self._async_lock is None:
+            self._async_lock = asyncio.Lock()
+
+        async with self._async_lock:
+            if not self.can_make_request():
+                sleep_time = (1 - self.tokens) / self.rate
+                self.logger.info("Waiting %f seconds until a request can be made", sleep_time)
+                await asyncio.sleep(sleep_time)
+
+            self.tokens -= 1
+
+    async def make_api_request_async(self, url: str, cache: bool = False) -> Optional[Dict]:
+        """
+        Makes an API request, given a URL, without blocking the event loop.
+        Many requests can be in flight at once; each waits its turn in the
+        rate limiter before being sent.
+
+        Args:
+            url (str): The URL to make the API request to.
 
         Returns:
-            float or None: The oldest request time, or None if the queue is empty.
+            dict or None: The decoded JSON response, or None if the request failed.
         """
-        if len(self.queue) < self.max_requests:
-            return self.queue.popleft()
+        data = self._cached_response(url, cache)
+        if data is not None:
+            return data
 
-        return None
+        # a request for the same URL may already be in flight; share its result
+        # rather than spending another token on it
+        if url not in self._in_flight:
+            self._in_flight[url] = asyncio.ensure_future(self._fetch_async(url, cache))
 
-    def _remove_expired_requests(self):
+        return await self._in_flight[url]
+
+    async def _fetch_async(self, url: str, cache: bool) -> Optional[Dict]:
         """
-        Removes expired requests from the queue.
+        Fetches a URL from the API once the rate limiter allows it.
+
+        Args:
+            url (str): The URL to make the API request to.
+            cache (bool): Whether to write the response to the on-disk cache.
 
-        An expired request is one that has been in the queue for longer than the time window.
+        Returns:
+            dict or None: The decoded JSON response, or None if the request failed.
         """
-        current_time = time.time()
-        while self.queue and current_time - self.queue[0] > self.time_window:
-            self.queue.popleft()
+        if self._in_flight_slots is None:
+            self._in_flight_slots = asyncio.Semaphore(self.max_in_flight)
 
-    def can_make_request(self):
+        try:
+            for attempt in range(self.max_retries + 1):
+                await self.wait_until_request_possible_async()
+                # never have more requests in flight than pooled connections
+                async with self._in_flight_slots:
+                    response = await asyncio.to_thread(self._send, url)
+                rate_limited = response is not None and response.status_code == 429
+                if not rate_limited or attempt == self.max_retries:
+                    break
+
+                retry_delay = self._retry_delay(response, attempt)
+                self.logger.warning("API request to %s was rate limited, retrying in %.1f seconds",
+                                    url, retry_delay)
+                await asyncio.sleep(retry_delay)
+
+            return self._store_response(url, self._decode(url, response), cache)
+        finally:
+            del self._in_flight[url]
+
+    def _cached_response(self, url: str, cache: bool) -> Optional[Dict]:
         """
-        Checks if a request can be made based on the current state of the request queue.
+        Looks up a response without going to the network, first among the responses
+        seen during this run and then, if `cache` is set, in the on-disk cache.
+
+        Args:
+            url (str): The URL of the API request.
+            cache (bool): Whether to read from the on-disk cache.
 
         Returns:
-            bool: True if a request can be made, False otherwise.
+            dict or None: The response, or None if it has not been fetched before.
         """
-        if len(self.queue) < self.max_requests:
-            return True
-        if time.time() - self.queue[0] < self.time_window:
-            return False
-        return True
+        data = self._mem_cache.get(url)
+        if data is None and cache and not self.refresh_cache:
+            data = self._read_from_cache(url)
 
-    def wait_until_request_possible(self):
+        return data
+
+    def _open_cache(self) -> sqlite3.Connection:
         """
-        Waits until a request can be made based on the current state of the request queue.
+        Opens the on-disk response cache, creating it on first use.
+
+        All responses are kept in a single SQLite database keyed by URL, so a
+        lookup is one indexed query rather than a file open per URL.
+
+        Returns:
+            sqlite3.Connection: The connection to the cache database.
         """
-        while not self.can_make_request():
-            sleep_time = self.time_window - (time.time() - self.queue[0])
-            if sleep_time > 0:
-                self.logger.info("Waiting %f seconds until a request can be made", sleep_time)
-                time.sleep(sleep_time + 0.05)
+        if self._cache_db is None:
+            # make sure the cache directory exists
+            os.makedirs("cache", exist_ok=True)
+            self._cache_db = sqlite3.connect("cache/api_cache.sqlite")
+            self._cache_db.execute("PRAGMA journal_mode=WAL")
+            self._cache_db.execute(
+                "CREATE TABLE IF NOT EXISTS responses "
+                "(url TEXT PRIMARY KEY, body BLOB NOT NULL, fetched_at REAL, etag TEXT)"
+            )
 
-    def make_api_request(self, url: str, cache: bool = False) -> Optional[Dict]:
+        return self._cache_db
+
+    def _read_from_cache(self, url: str) -> Optional[Dict]:
         """
-        Makes an API request, given a URL, taking the timing into account.
-        If we cannot make a request, then wait the minimum time until we can.
+        Reads the response for a URL from the on-disk cache.
+        Responses older than `cache_expiry` count as a miss.
 
         Args:
-            url (str): The URL to make the API request to.
+            url (str): The URL of the API request.
 
         Returns:
-            bool: True if the request was successful, False otherwise.
+            dict or None: The cached response, or None on a cache miss.
         """
-        # read from the cache if we can
-        if cache:
-            self.logger.debug("Checking cache for %s", url)
-            try:
-                with open(f"cache/{url.replace('/', '_')}.json", "r", encoding='utf-8') as f:
-                    self.logger.debug("Reading from cache")
-                    return json.load(f)
-            except FileNotFoundError:
-                self.logger.debug("Cache miss")
+        self.logger.debug("Checking cache for %s", url)
+        row = self._open_cache().execute(
+            "SELECT body, fetched_at FROM responses WHERE url = ?", (url,)
+        ).fetchone()
+        if row is None:
+            self.logger.debug("Cache miss")
+            return None
+
+        body, fetched_at = row
+        if fetched_at is None or time.time() - fetched_at > self.cache_expiry:
+            self.logger.debug("Cached response has expired")
+            return None
+
+        try:
+            self.logger.debug("Reading from cache")
+            data = orjson.loads(body)
+        except orjson.JSONDecodeError:
+            self.logger.warning("Ignoring unreadable cache entry for %s", url)
+            return None
 
-        if not self.can_make_request():
-            self.wait_until_request_possible()
+        self._mem_cache[url] = data
+        return data
 
-        request_time = time.time()
-        self.enqueue(request_time)
+    def _send(self, url: str) -> Optional[requests.Response]:
+        """
+        Sends a GET request to the API. The caller is responsible for the rate limiting.
+
+        Args:
+            url (str): The URL to make the API request to.
 
+        Returns:
+            requests.Response or None: The response, or None if no response arrived.
+        """
         try:
-            response = requests.get(url, timeout=5)
+            return self.session.get(url, timeout=5)
         except requests.exceptions.Timeout:
             self.logger.warning("API request to %s timed out", url)
-            return None
         except requests.exceptions.ConnectionError:
             self.logger.warning("API request to %s failed due to a connection error", url)
+
+        return None
+
+    def _retry_delay(self, response: requests.Response, attempt: int) -> float:
+        """
+        Gets how long to wait before retrying a rate-limited request: as long as the
+        server asks for in its Retry-After header, or else a doubling backoff.
+
+        Args:
+            response (requests.Response): The rate-limited response.
+            attempt (int): The number of retries made so far.
+
+        Returns:
+            float: The time (in seconds) to wait.
+        """
+        try:
+            return float(response.headers['Retry-After'])
+        except (KeyError, ValueError):
+            return self.time_window * 2 ** attempt
+
+    def _decode(
+        self, url: str, response: Optional[requests.Response]
+    ) -> Optional[Tuple[Dict, requests.Response]]:
+        """
+        Decodes the JSON body of a response from the API.
+
+        Args:
+            url (str): The URL the request was made to.
+            response (requests.Response or None): The result of `_send` for the URL.
+
+        Returns:
+            tuple or None: The decoded JSON response and the response itself,
+                or None if the request failed.
+        """
+        if response is None:
+            return None
+
+        if not response.ok:
+            self.logger.warning("API request to %s failed with status %i", url, response.status_code)
             return None
 
         self.logger.debug("API request to %s successful", url)
-        self.logger.debug("%i requests have been made in the last %i seconds",
-                         len(self.queue), self.time_window)
+        self.logger.debug("%.1f requests can still be made without waiting", self.tokens)
+
+        try:
+            data = orjson.loads(response.content)
+        except orjson.JSONDecodeError:
+            self.logger.warning("API request to %s did not return valid JSON", url)
+            return None
 
+        return data, response
+
+    def _store_response(
+        self, url: str, fetched: Optional[Tuple[Dict, requests.Response]], cache: bool
+    ) -> Optional[Dict]:
+        """
+        Keeps a fetched response in memory and, if requested, in the on-disk cache,
+        together with the time it was fetched and its ETag.
+
+        Args:
+            url (str): The URL of the API request.
+            fetched (tuple or None): The result of `_decode` for the URL.
+            cache (bool): Whether to write the response to the on-disk cache.
+
+        Returns:
+            dict or None: The decoded JSON response, or None if the request failed.
+        """
+        if fetched is None:
+            return None
+
+        data, response = fetched
         if cache:
             self.logger.info("Caching response from %s", url)
-            # make sure the cache directory exists
-            os.makedirs("cache", exist_ok=True)
-            # write to the cache
-            with open(f"cache/{url.replace('/', '_')}.json", "w", encoding='utf-8') as f:
-                json.dump(response.json(), f, indent=2)
+            # write the raw body to the cache; it has already been parsed
+            with self._open_cache() as db:
+                db.execute(
+                    "INSERT OR REPLACE INTO responses (url, body, fetched_at, etag) "
+                    "VALUES (?, ?, ?, ?)",
+                    (url, response.content, time.time(), response.headers.get('ETag'))
+                )
+
+        self._mem_cache[url] = data
+        return data
+
+    async def find_titles_from_inspire_records_async(
+        self, record_nums: List[str], cache: bool = True
+    ) -> Dict[str, str]:
+        """
+        Get the titles of several INSPIRE records from their record IDs.
+
+        Records that are not in the title cache are looked up together, with
+        up to `title_batch_size` records per search query, as long as the query
+        stays within `max_title_query_length` characters. The search queries
+        are sent concurrently.
+
+        Args:
+            record_nums (list): The record IDs of the INSPIRE records.
 
-        return response.json()
+        Returns:
+            dict: A mapping from record ID to the title of the INSPIRE record.
+        """
+        titles, batches = self._split_cached_titles(record_nums, cache)
+
+        responses = await asyncio.gather(*(
+            self.make_api_request_async(self._title_search_url(batch), cache=False)
+            for batch in batches
+        ))
+        for batch, response in zip(batches, responses):
+            self._add_title_search_results(batch, response, titles, cache)
+
+        return titles
 
-    def find_title_from_inspire_record(
-        self, record_num: str, cache:bool = True
-    ) -> str:
+    def _split_cached_titles(
+        self, record_nums: List[str], cache: bool
+    ) -> Tuple[Dict[str, str], List[List[str]]]:
         """
-        Get the title of an INSPIRE record from its record ID.
+        Looks up titles in the title cache, and groups the remaining records into
+        batches for searching.
 
         Args:
-            record (str): The record ID of the INSPIRE record.
+            record_nums (list): The record IDs of the INSPIRE records.
+            cache (bool): Whether to read from the title cache.
 
         Returns:
-            str: The title of the INSPIRE record.
+            tuple: The cached titles, and the batches of records still to be searched.
         """
+        titles = {}
+        missing = []
+        for record_num in dict.fromkeys(record_nums):
+            title = None
+            if cache and not self.refresh_cache:
+                title = self._load_title_cache().get(record_num)
+            if title is None:
+                missing.append(record_num)
+            else:
+                titles[record_num] = title
+
+        self.logger.debug("%i of %i titles found in cache", len(titles), len(record_nums))
+
+        # Batches are limited both in number of records and in query length,
+        # so that the search URL never grows too long for the server
+        batches: List[List[str]] = []
+        query_length = 0
+        for record_num in missing:
+            term_length = len(f"+or+recid:{record_num}")
+            if (not batches or len(batches[-1]) == self.title_batch_size
+                    or query_length + term_length > self.max_title_query_length):
+                batches.append([])
+                query_length = 0
+            batches[-1].append(record_num)
+            query_length += term_length
+
+        return titles, batches
+
+    @staticmethod
+    def _title_search_url(batch: List[str]) -> str:
+        """
+        Builds the URL of a search query for the titles of a batch of records.
+
+        Args:
+            batch (list): The record IDs of the INSPIRE records.
+
+        Returns:
+            str: The URL of the search query.
+        """
+        query = '+or+'.join(f"recid:{record_num}" for record_num in batch)
+        return (f"https://inspirehep.net/api/literature?q={query}"
+                f"&fields=titles,control_number&size={len(batch)}")
+
+    def _add_title_search_results(
+        self, batch: List[str], response: Optional[Dict],
+        titles: Dict[str, str], cache: bool
+    ):
+        """
+        Adds the titles from a search query response to `titles`, using 'No title'
+        for any record that the response does not cover.
+
+        Args:
+            batch (list): The record IDs that were searched for.
+            response (dict or None): The search query response.
+            titles (dict): The mapping from record ID to title to add to.
+            cache (bool): Whether to write the titles to the title cache.
+        """
+        if response is None:
+            self.logger.warning("Failed to get response during title search for records %s",
+                                ', '.join(batch))
+            for record_num in batch:
+                titles[record_num] = 'No title'
+            return
+
+        found = {}
+        for hit in response.get('hits', {}).get('hits', []):
+            try:
+                found[str(hit['metadata']['control_number'])] = \
+                    hit['metadata']['titles'][0]['title']
+            except KeyError:
+                continue
+
+        batch_titles = {}
+        for record_num in batch:
+            if record_num not in found:
+                self.logger.warning('No title found for record %s', record_num)
+            batch_titles[record_num] = found.get(record_num, 'No title')
+
+        titles.update(batch_titles)
         if cache:
-            self.logger.debug("Checking title cache for %s", record_num)
+            self._store_titles(batch_titles)
+
+    def _load_title_cache(self) -> Dict[str, str]:
+        """
+        Loads the on-disk title cache into memory, reading the file only once.
+
+        Returns:
+            dict: A mapping from INSPIRE record ID to title.
+        """
+        if self._title_cache is None:
+            self._title_cache = {}
             try:
                 with open("cache/title_cache.txt", "r", encoding='utf-8') as f:
                     for line in f:
-                        if line.startswith(record_num):
-                            self.logger.debug("Reading title from cache")
-                            return line.split(',')[1].strip()
+                        record_num, _, title = line.rstrip('\n').partition(',')
+                        if title:
+                            self._title_cache[record_num] = title.strip()
             except FileNotFoundError:
-                self.logger.debug("Cache miss")
+                self.logger.debug("No title cache on disk yet")
 
-        url = f"https://inspirehep.net/api/literature?q=recid:{record_num}&fields=titles"
-        response = self.make_api_request(url, cache=False)
-        if response is None:
-            self.logger.warning("Failed to get response during title search for record %s", record_num)
-            return 'No title'
+        return self._title_cache
 
-        try:
-            title = response['hits']['hits'][0]['metadata']['titles'][0]['title']
-        except KeyError:
-            self.logger.warning('No title found for record %s', record_num)
-            title = 'No title'
-
-        if cache:
-            self.logger.debug("Caching title for %s", record_num)
-            # make sure the cache directory exists
-            os.makedirs("cache", exist_ok=True)
-            # write a new line to the title cache
-            with open("cache/title_cache.txt", "a", encoding='utf-8') as f:
-                f.write(f"{record_num},{title}\n")
+    def _store_titles(self, titles: Dict[str, str]):
+        """
+        Adds titles to the in-memory title cache and appends them to the on-disk cache,
+        opening the file once for all of them.
 
-        return title
+        Args:
+            titles (dict): A mapping from INSPIRE record ID to title.
+        """
+        self.logger.debug("Caching %i titles", len(titles))
+        self._load_title_cache().update(titles)
+        # make sure the cache directory exists
+        os.makedirs("cache", exist_ok=True)
+        # write one line per title to the title cache
+        with open("cache/title_cache.txt", "a", encoding='utf-8') as f:
+            f.writelines(f"{record_num},{title}\n" for record_num, title in titles.items())
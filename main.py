@@ -4,16 +4,27 @@ Main script for the HEP graph creator.
 Copyright: 2024 by Kees Benkendorfer
 """
 
+import argparse
+import asyncio
+import hashlib
+import json
 import logging
 import os
+import time
 
-from typing import List, Optional
+from typing import Container, Dict, List, Optional
 
 import graph_tool.all as gt
+import numpy as np
 from matplotlib.cm import gist_heat
 
 import matplotlib.pyplot as plt
 
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
 from node import Node, NodeType
 from api_request_manager import APIRequestManager
 
@@ -29,100 +40,80 @@ if os.path.exists(log_file):
 logging.basicConfig(filename='app.log', level=logging.INFO,
                     format='%(asctime)s - %(levelname)s - %(message)s')
 
+# Only request the parts of a record that are used, since full
+# INSPIRE records can be hundreds of kB
+RECORD_FIELDS = 'titles,references.record'
 
-def get_inspire_nodes_from_url(
-    url: str, api_manager: APIRequestManager,
-    record_filter: Optional[List[str]] = None
-) -> List[Node]:
+
+async def fetch_inspire_record(
+    url: str, api_manager: APIRequestManager
+) -> Optional[Dict]:
     """
-    Get INSPIRE record from URL
+    Fetch the fields of an INSPIRE record that are used to build the graph
     """
     logging.info("Fetching data from %s", url)
-    response = api_manager.make_api_request(url, cache=True)
-    if response is None:
+    data = await api_manager.make_api_request_async(f"{url}?fields={RECORD_FIELDS}", cache=True)
+    if data is None:
         logging.error("Failed to fetch data from %s", url)
-        return []
-    data = response
 
+    return data
+
+
+def get_referenced_records(
+    data: Dict, record_filter: Optional[Container[str]] = None
+) -> List[str]:
+    """
+    Get the INSPIRE records referenced by an already fetched INSPIRE record
+    """
     try:
         references = data['metadata']['references']
     except KeyError:
         logging.info('No references found')
         return []
 
-    nodes = []
+    records = []
     for ref in references:
-        if 'record' not in ref:
+        ref_record = ref.get('record')
+        if ref_record is None:
             logging.debug('Reference has no INSPIRE record, skipping...')
             continue
 
-        record = ref['record']['$ref']
+        record = ref_record['$ref']
 
         if (record_filter is not None) and (record not in record_filter):
             logging.debug('Reference is not in the record filter, skipping...')
             continue
 
-        try:
-            record_num = record.split('/')[-1]
-            title = api_manager.find_title_from_inspire_record(record_num, cache=True)
-        except KeyError:
-            logging.info(ref)
-            logging.warning('KeyError, no title found')
-            title = 'No title'
-
-        new_node = Node(record=record, title=title)
-        nodes += [new_node]
+        records.append(record)
 
-    logging.info('Found %d references with INSPIRE records', len(nodes))
+    return records
 
-    return nodes
 
-
-def get_inspire_nodes_from_arxiv(
-    arxiv_id: str, api_manager: APIRequestManager, seed_node: Node
+async def get_inspire_nodes_from_record_data(
+    data: Dict, api_manager: APIRequestManager,
+    record_filter: Optional[Container[str]] = None
 ) -> List[Node]:
     """
-    Get INSPIRE record from arXiv ID
+    Get nodes for the INSPIRE records referenced by an already fetched INSPIRE record
     """
-    url = f"https://inspirehep.net/api/arxiv/{arxiv_id}"
-    nodes = get_inspire_nodes_from_url(url, api_manager)
+    records = get_referenced_records(data, record_filter)
 
-    for new_node in nodes:
-        new_node.add_parent(seed_node)
+    # Resolve all titles in one pass so uncached records can be batched
+    record_nums = [record.rpartition('/')[2] for record in records]
+    titles = await api_manager.find_titles_from_inspire_records_async(record_nums, cache=True)
 
-    return nodes
+    nodes = [Node(record=record, title=titles[record_num])
+             for record, record_num in zip(records, record_nums)]
 
-
-def get_inspire_nodes_from_inspire(
-    inspire_ref: str, api_manager: APIRequestManager, seed_node: Node
-) -> List[Node]:
-    """
-    Get INSPIRE record from INSPIRE record
-    """
-    url = f"https://inspirehep.net/api/literature/{inspire_ref}"
-    nodes = get_inspire_nodes_from_url(url, api_manager)
-
-    for new_node in nodes:
-        new_node.add_parent(seed_node)
+    logging.info('Found %d references with INSPIRE records', len(nodes))
 
     return nodes
 
 
-def seed_node_from_inspire(
-    inspire_ref: str, api_manager: APIRequestManager
-) -> Optional[Node]:
+def seed_node_from_record_data(url: str, data: Dict) -> Node:
     """
-    Add seed node from INSPIRE record
+    Add seed node from an already fetched INSPIRE record
     """
-    url = f"https://inspirehep.net/api/literature/{inspire_ref}"
-    logging.info("Fetching data from %s", url)
-    response = api_manager.make_api_request(url, cache=True)
-    if response is None:
-        logging.error("Failed to fetch data from %s", url)
-        return None
-
-    data = response
-
     try:
         title = data['metadata']['titles'][0]['title']
     except KeyError:
@@ -136,31 +127,6 @@ def seed_node_from_inspire(
     return node
 
 
-def seed_node_from_arxiv(
-    arxiv_id: str, api_manager: APIRequestManager
-) -> Optional[Node]:
-    """
-    Add seed node from arXiv ID
-    """
-    url = f"https://inspirehep.net/api/arxiv/{arxiv_id}"
-    logging.info("Fetching data from %s", url)
-    response = api_manager.make_api_request(url, cache=True)
-    if response is None:
-        logging.error("Failed to fetch data from %s", url)
-        return None
-
-    data = response
-
-    metadata = data['metadata']
-
-    node = Node(record=url,
-                title=metadata['titles'][0]['title'],
-                node_type=NodeType.SEED)
-    logging.info('Created seed node')
-
-    return node
-
-
 def remove_duplicates(all_nodes):
     """
     Remove duplicates from a list of nodes based on their record attribute.
@@ -172,25 +138,49 @@ def remove_duplicates(all_nodes):
     Returns:
         list: A list of unique nodes with merged parents.
     """
-    unique_nodes = []
-    record_set = set()
+    unique_nodes: Dict[str, Node] = {}
 
     for node in all_nodes:
-        if node.record not in record_set:
-            unique_nodes.append(node)
-            record_set.add(node.record)
+        existing_node = unique_nodes.get(node.record)
+        if existing_node is None:
+            unique_nodes[node.record] = node
         else:
             # Merge parents into the first node
-            existing_node = next((n for n in unique_nodes if n.record == node.record), None)
-            if existing_node is not None:
-                existing_node.parents = existing_node.parents.union(node.parents)
+            existing_node.parents |= node.parents
+
+    return list(unique_nodes.values())
+
+
+async def get_nodes_from_seed(seed, api_manager):
+    """
+    Retrieves the seed node and its references for a single seed.
+    Both come from a single fetch of the seed record.
+
+    Args:
+        seed (str): The INSPIRE record of the seed.
+        api_manager (object): An instance of the API manager.
+
+    Returns:
+        list: The seed node followed by its references, or an empty list on failure.
+    """
+    url = f"https://inspirehep.net/api/literature/{seed}"
+    data = await fetch_inspire_record(url, api_manager)
+    if data is None:
+        logging.error('Failed to create seed node from INSPIRE record %s', seed)
+        return []
+
+    seed_node = seed_node_from_record_data(url, data)
+    references = await get_inspire_nodes_from_record_data(data, api_manager)
+    for new_node in references:
+        new_node.add_parent(seed_node)
 
-    return unique_nodes
+    return [seed_node] + references
 
 
-def get_nodes_from_seeds(seeds, api_manager):
+async def get_nodes_from_seeds(seeds, api_manager):
     """
     Retrieves a list of references from the given seeds.
+    The seeds are fetched concurrently.
 
     Args:
         seeds (list): A list of seed values.
@@ -199,37 +189,52 @@ def get_nodes_from_seeds(seeds, api_manager):
     Returns:
         list: A list of unique nodes.
     """
-    all_nodes = []
-    for seed in seeds:
-        seed_node = seed_node_from_inspire(seed, api_manager)
-        if seed_node is None:
-            logging.error('Failed to create seed node from INSPIRE record %s', seed)
-            continue
-        references = get_inspire_nodes_from_inspire(seed, api_manager, seed_node)
+    # gather preserves the order of the seeds
+    seed_nodes = await asyncio.gather(
+        *(get_nodes_from_seed(seed, api_manager) for seed in seeds)
+    )
 
-        all_nodes += [seed_node]
-        all_nodes += references
+    all_nodes = []
+    for nodes in seed_nodes:
+        all_nodes.extend(nodes)
 
     all_nodes = remove_duplicates(all_nodes)
     logging.info('Found %d unique nodes', len(all_nodes))
     return all_nodes
 
 
-def add_inter_node_citation(
-    nodes: List[Node], citing_node: Node, cited_node: Node
+async def find_citations_from_node(
+    nodes_by_record: Dict[str, Node], citing_node: Node, api_manager: APIRequestManager
 ):
+    """
+    Find the citations from one node to the other nodes in the given list.
+
+    Args:
+        nodes_by_record (dict): The nodes in the list, keyed by record.
+        citing_node (Node): The node whose references are searched.
+    """
+    logging.info('Finding inter-node citations for %s', citing_node.record)
+
+    data = await fetch_inspire_record(citing_node.record, api_manager)
+    if data is None:
+        return
+
+    # We only record citations to nodes that are
+    # in the original list; the dict doubles as the record filter.
+    # The cited nodes already exist, so their titles are not needed.
+    #
     # Parent relationship is defined such that
     # the citing node is the parent of the cited node
-    for node in nodes:
-        if node == cited_node:
-            node.add_parent(citing_node)
+    for record in get_referenced_records(data, record_filter=nodes_by_record):
+        nodes_by_record[record].add_parent(citing_node)
 
 
-def find_inter_node_citations(
+async def find_inter_node_citations(
     nodes: List[Node], api_manager: APIRequestManager
 ):
     """
     Find citations between nodes in the given list.
+    The references of all nodes are fetched concurrently, within the rate limit.
 
     Args:
         nodes (list): A list of nodes.
@@ -237,51 +242,158 @@ def find_inter_node_citations(
     Returns:
         list: A list of nodes with citations.
     """
-    record_filter = [node.record for node in nodes]
-
-    for i, citing_node in enumerate(nodes):
-        logging.info('Finding inter-node citations for node %d/%d', i + 1, len(nodes))
-        # We only want to consider non-seed nodes
-        if citing_node.node_type == NodeType.SEED:
-            continue
+    nodes_by_record = {node.record: node for node in nodes}
 
-        # We only record citations to nodes that are
-        # in the original list
-        cited_nodes = get_inspire_nodes_from_url(
-            citing_node.record, api_manager, record_filter=record_filter
-        )
+    # We only want to consider non-seed nodes; seeds that failed to
+    # fetch never made it into the list
+    work = [node for node in nodes if node.node_type != NodeType.SEED]
 
-        for cited_node in cited_nodes:
-            add_inter_node_citation(nodes, citing_node, cited_node)
+    logging.info('Finding inter-node citations for %d of %d nodes', len(work), len(nodes))
+    await asyncio.gather(*[
+        find_citations_from_node(nodes_by_record, citing_node, api_manager)
+        for citing_node in work
+    ])
 
     return nodes
 
 
-API_MANAGER = APIRequestManager()
+async def build_graph_nodes(seeds, api_manager):
+    """
+    Retrieves the nodes for the given seeds, together with the citations between them.
+    Everything runs in a single event loop, shared by all API requests.
+
+    Args:
+        seeds (list): A list of seed values.
+        api_manager (object): An instance of the API manager.
+
+    Returns:
+        list: A list of unique nodes with citations.
+    """
+    all_nodes = await get_nodes_from_seeds(seeds, api_manager)
+    return await find_inter_node_citations(all_nodes, api_manager)
+
+
+def graph_cache_path(seeds: List[str]) -> str:
+    """
+    Gets the path at which the nodes built from the given seeds are saved.
+
+    Args:
+        seeds (list): A list of seed values.
+
+    Returns:
+        str: The path of the saved graph, named after a hash of the seeds.
+    """
+    key = hashlib.sha1(json.dumps(sorted(seeds)).encode('utf-8')).hexdigest()[:12]
+    return os.path.join('.graph_cache', f'{key}.json')
+
+
+def save_graph_nodes(path: str, nodes: List[Node], seeds: List[str]):
+    """
+    Saves the nodes of a graph, so that a later run can skip fetching them.
+
+    Args:
+        path (str): The path to save the graph to.
+        nodes (list): A list of nodes with citations.
+        seeds (list): The seeds the nodes were built from.
+    """
+    graph = {
+        'seeds': seeds,
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'nodes': [
+            {'record': node.record, 'title': node.title, 'node_type': node.node_type.value,
+             'parents': list(node.parents)}
+            for node in nodes
+        ],
+    }
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(graph, f)
+    logging.info('Saved %d nodes to %s', len(nodes), path)
+
+
+def load_graph_nodes(path: str) -> Optional[List[Node]]:
+    """
+    Loads the nodes of a graph saved by save_graph_nodes.
+
+    Args:
+        path (str): The path the graph was saved to.
+
+    Returns:
+        list or None: A list of nodes with citations, or None if there is no saved
+            graph or it cannot be read, so that the graph is built again.
+    """
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            graph = json.load(f)
+    except FileNotFoundError:
+        logging.info('No saved graph at %s', path)
+        return None
+    except ValueError:
+        # json.JSONDecodeError, e.g. from a truncated file
+        logging.warning('Ignoring unreadable saved graph at %s', path)
+        return None
+
+    try:
+        created = graph['created']
+        nodes_by_record = {
+            entry['record']: Node(record=entry['record'], title=entry['title'],
+                                  node_type=NodeType(entry['node_type']))
+            for entry in graph['nodes']
+        }
+        for entry in graph['nodes']:
+            nodes_by_record[entry['record']].add_parents(
+                nodes_by_record[parent_record] for parent_record in entry['parents']
+            )
+    except (KeyError, TypeError, ValueError):
+        logging.warning('Ignoring malformed saved graph at %s', path)
+        return None
+
+    logging.info('Loaded %d nodes saved on %s from %s',
+                 len(nodes_by_record), created, path)
+    return list(nodes_by_record.values())
+
+
+PARSER = argparse.ArgumentParser(description="Create a citation graph of HEP papers from INSPIRE")
+PARSER.add_argument('--no-cache', action='store_true',
+                    help="ignore cached INSPIRE responses and fetch everything again")
+PARSER.add_argument('--reuse-graph', action='store_true',
+                    help="reuse the graph saved by an earlier run with the same seeds")
+ARGS = PARSER.parse_args()
+
+API_MANAGER = APIRequestManager(refresh_cache=ARGS.no_cache)
 
 SEEDS = ["1900929", #"1815227",
          "2037744", #"2077575", "2732688"
          ]
 
-ALL_NODES = get_nodes_from_seeds(SEEDS, API_MANAGER)
-
-find_inter_node_citations(ALL_NODES, API_MANAGER)
+GRAPH_CACHE_PATH = graph_cache_path(SEEDS)
+ALL_NODES = load_graph_nodes(GRAPH_CACHE_PATH) if ARGS.reuse_graph else None
+if ALL_NODES is None:
+    # uvloop is optional; the default event loop works, just with more overhead
+    if uvloop is not None:
+        ALL_NODES = uvloop.run(build_graph_nodes(SEEDS, API_MANAGER))
+    else:
+        ALL_NODES = asyncio.run(build_graph_nodes(SEEDS, API_MANAGER))
+    save_graph_nodes(GRAPH_CACHE_PATH, ALL_NODES, SEEDS)
 
 logging.info('Generating graph...')
 
-# create adjacency matrix
-adjacency_matrix = {}
-for NODE in ALL_NODES:
-    if NODE.record not in adjacency_matrix:
-        adjacency_matrix[NODE.record] = []
-    for parent in NODE.parents:
-        if parent.record not in adjacency_matrix:
-            adjacency_matrix[parent.record] = []
-        adjacency_matrix[parent.record] += [NODE.record]
+# Number the nodes by their position in ALL_NODES and pack the citation edges
+# into one (parent, child) array, so graph-tool gets integer vertices directly
+# and vertex i is ALL_NODES[i]. Parents are sets, so no edge appears twice.
+INDEX_BY_RECORD = {NODE.record: NODE_I for NODE_I, NODE in enumerate(ALL_NODES)}
+EDGES = np.array(
+    [(INDEX_BY_RECORD[parent_record], NODE_I)
+     for NODE_I, NODE in enumerate(ALL_NODES) for parent_record in NODE.parents],
+    dtype=np.int32
+).reshape(-1, 2)
 
 # create a graph-tools graph from ALL_NODES
-g = gt.Graph(adjacency_matrix, directed=True, hashed=True)
-pos = gt.sfdp_layout(g)
+g = gt.Graph(directed=True)
+g.add_vertex(len(ALL_NODES))
+g.add_edge_list(EDGES)
+pos = gt.sfdp_layout(g, multilevel=True)
 gt.graph_draw(g, pos=pos, output="output.pdf")
 # draw the graph, sizing by degree
 deg = g.degree_property_map("in")
@@ -296,21 +408,24 @@ pr = gt.pagerank(g)
 # Sort the nodes by pagerank
 sorted_nodes = sorted(g.iter_vertices(), key=lambda v: pr[v], reverse=True)
 
-gt.graph_draw(g, vertex_fill_color=pr,
+gt.graph_draw(g, pos=pos, vertex_fill_color=pr,
               vertex_size=gt.prop_to_size(pr, mi=-1, ma=2, power=0.1),
               vorder=pr, vcmap=gist_heat, vertex_text=g.vertex_index, mplfig=ax[0])
 
 # Print the top 10 nodes by pagerank
-TEXT = ""
+n_chars = 120
+
+# Collect the lines and join them once, rather than growing a string
+TEXT_LINES = []
 for NODE_I, NODE in enumerate(sorted_nodes[:10]):
     # remove the api from the record
     record_to_print = ALL_NODES[NODE].record.replace('api/', '')
-    TEXT += f"Rank {NODE_I+1}: Node {g.vertex_index[NODE]}, {record_to_print} - Pagerank: {pr[NODE]:.2f}\n"
-
-    n_chars = 120
+    TEXT_LINES.append(f"Rank {NODE_I+1}: Node {g.vertex_index[NODE]}, {record_to_print} - Pagerank: {pr[NODE]:.2f}\n")
 
     title = (ALL_NODES[NODE].title[:n_chars] + "...") if len(ALL_NODES[NODE].title) > n_chars else ALL_NODES[NODE].title
-    TEXT += rf"Title: {title}" + "\n\n"
+    TEXT_LINES.append(rf"Title: {title}" + "\n\n")
+
+TEXT = "".join(TEXT_LINES)
 
 print(TEXT)
 
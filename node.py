@@ -1,7 +1,10 @@
 import logging
-from typing import Set
+import sys
+from typing import Iterable, Set
 from enum import Enum
 
+logger = logging.getLogger(__name__)
+
 class NodeType(Enum):
     REFERENCE = 0
     SEED = 1
@@ -13,37 +16,79 @@ class Node:
     Attributes:
         record (str): The record of the node.
         title (str): The title of the node.
-        parents (set): Set of parent nodes.
+        parents (set): Set of the records of parent nodes.
         node_type (NodeType): The type of the node.
     """
 
+    # Nodes are created for every reference, so avoid a per-instance __dict__.
+    # The record, title and type are only set in __init__ and exposed as
+    # read-only properties, since the cached hash depends on the record
+    __slots__ = ('_record', '_title', 'parents', '_node_type', '_hash')
+
     def __init__(self, record: str, title: str,
                  node_type: NodeType = NodeType.REFERENCE):
-        self.logger = logging.getLogger(__name__)
-
         if not isinstance(record, str):
-            self.logger.error("Attempted to create node with record %s", record)
+            logger.error("Attempted to create node with record %s", record)
             raise TypeError(f"Record must be a string, not {type(record)}")
         if not isinstance(title, str):
-            self.logger.error("Attempted to create node with title %s", title)
+            logger.error("Attempted to create node with title %s", title)
             raise TypeError(f"Title must be a string, not {type(title)}")
 
-        self.record = record
-        self.title = title
-        self.parents: Set[Node] = set()
-        self.node_type = node_type
+        # The same record appears in many nodes and parent sets; interning
+        # shares one string and lets comparisons short-circuit on identity
+        self._record = sys.intern(record)
+        # The record cannot change after construction, so hash it once
+        self._hash = hash(self._record)
+        # A paper referenced by many seeds gets a node, with its own copy of
+        # the title, per reference; share one copy until duplicates are merged
+        self._title = sys.intern(title)
+        # Parents are kept by record rather than by node, so parent sets hash
+        # cached strings and nodes do not hold references to each other
+        self.parents: Set[str] = set()
+        self._node_type = node_type
+
+    @property
+    def record(self) -> str:
+        """
+        The record of the node.
+
+        Returns:
+            str: The record of the node.
+        """
+        return self._record
+
+    @property
+    def title(self) -> str:
+        """
+        The title of the node.
+
+        Returns:
+            str: The title of the node.
+        """
+        return self._title
+
+    @property
+    def node_type(self) -> NodeType:
+        """
+        The type of the node.
+
+        Returns:
+            NodeType: The type of the node.
+        """
+        return self._node_type
 
     def __str__(self):
         return f"Record: {self.record}\nTitle: {self.title}"
 
     def __hash__(self):
         """
-        Returns the hash value of the node based on its record and title.
+        Returns the hash value of the node based on its record, consistent
+        with __eq__.
 
         Returns:
             int: The hash value of the node.
         """
-        return hash((self.record, self.title))
+        return self._hash
 
     def __eq__(self, other):
         """
@@ -53,15 +98,20 @@ class Node:
             other (Node): The other node to compare.
 
         Returns:
-            bool: True if the nodes are equal, False otherwise.
+            bool: True if the nodes are equal, False otherwise, or
+            NotImplemented if other is not a node.
         """
-        if isinstance(other, Node):
-            return self.record == other.record
-        return False
+        # Nodes are usually compared with themselves
+        if self is other:
+            return True
+        # Records are always interned, so equal records are the same object
+        if type(other) is Node:
+            return self._record is other._record
+        return NotImplemented
 
     def add_parent(self, parent_node: 'Node'):
         """
-        Adds a parent node to the current node.
+        Adds the record of a parent node to the current node.
 
         Parameters:
             parent_node (Node): The parent node to be added.
@@ -69,6 +119,16 @@ class Node:
         Returns:
             None
         """
-        if not isinstance(parent_node.record, str):
-            print(parent_node)
-        self.parents.add(parent_node)
+        self.parents.add(parent_node._record)
+
+    def add_parents(self, parent_nodes: Iterable['Node']):
+        """
+        Adds the records of several parent nodes to the current node at once.
+
+        Parameters:
+            parent_nodes (iterable): The parent nodes to be added.
+
+        Returns:
+            None
+        """
+        self.parents.update(parent_node._record for parent_node in parent_nodes)